@@ -1,20 +1,36 @@
 #!/usr/bin/env python3
 
-import json
+import copy
 import logging
 import os
+import shutil
+import tempfile
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Tuple, Union
 
 import paho.mqtt.client as mqtt
 import yaml
 
-from pydevice2mqtt.remote_devices import RemoteDevice, supported_device_classes
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
+
+from pydevice2mqtt.remote_devices import RemoteDevice, supported_device_classes, encode_json
+
+logger = logging.getLogger(__name__)
+
+# marks topics without an entry in the subscribed channels (None is a valid entry for sensors)
+_MISSING = object()
 
 
 class DeviceBridge:
     _supported_device_classes = supported_device_classes()
 
+    # paho allows only 20 unacknowledged qos>0 messages by default,
+    # which throttles the discovery burst of bridges with many devices
+    _MAX_INFLIGHT_MESSAGES = 1000
+
     @classmethod
     def update_config(cls,
                       devices: Dict[str, Dict[str, dict]] = None,
@@ -24,6 +40,8 @@ class DeviceBridge:
         """Create a config out of a dictionary.
         Only allowes to create or add devices to a config,
         to ensure that the info for removing will not be deleted
+        The config is written to a temporary file next to it and renamed afterwards,
+        this requires write permission on the directory of the config.
 
         :param devices: Configuration values for new items (see remote_devices.py for supported devices)
         :param config_file: target file name to create or update
@@ -35,15 +53,19 @@ class DeviceBridge:
         """
 
         config_file = Path(config_file)
+        config_exists = config_file.is_file()
 
-        if config_file.is_file() and mqtt_settings is not None and not force_update:
+        if config_exists and mqtt_settings is not None and not force_update:
             raise ValueError("MQTT Settings can not be updated for existing file.")
 
         complete_config: dict = {"remote_devices": {}, "mqtt_settings": {}}
+        loaded_config = None
 
-        if config_file.is_file():
-            with open(config_file, "r") as config_stream:
-                complete_config = yaml.load(config_stream, yaml.SafeLoader)
+        if config_exists:
+            # libyaml reads and decodes the raw bytes itself
+            with open(config_file, "rb") as config_stream:
+                complete_config = yaml.load(config_stream, YamlLoader)
+            loaded_config = copy.deepcopy(complete_config)
             if force_update and mqtt_settings:
                   
                 complete_config.update(mqtt_settings)
@@ -70,33 +92,78 @@ class DeviceBridge:
             except KeyError as err:
                 raise AttributeError(f"Device {device_class_name} not supported") from err
 
+            config_req = device_class.get_config_req().items()
             for object_id, device_info in device_info_dict.items():
-                for key, value_type in device_class.get_config_req().items():
-                    try:
-                        assert isinstance(device_info[key], value_type)
-                    except (KeyError, AssertionError) as err:
-                        raise ValueError(f"The Device info is incomplete or provide wrong type ({key} {value_type})") from err
+                invalid_keys = [f"{key} {value_type}" for key, value_type in config_req
+                                if not isinstance(device_info.get(key), value_type)]
+                if invalid_keys:
+                    raise ValueError(f"The Device info is incomplete or provide wrong type ({', '.join(invalid_keys)})")
 
             # all infos correct, update dict
             if device_class_name in complete_config["remote_devices"].keys():
                 if not force_update:
-                    assert all(devices[device_class_name].keys()) not in complete_config["remote_devices"][
-                        device_class_name].keys(), \
-                        f"Found existing Device, updating {device_class_name} is forbidden!"
+                    # registering an unchanged device again is allowed, changing it is not
+                    existing_devices = complete_config["remote_devices"][device_class_name]
+                    changed_ids = [object_id for object_id in device_info_dict.keys() & existing_devices.keys()
+                                   if existing_devices[object_id] != device_info_dict[object_id]]
+                    assert not changed_ids, \
+                        f"Found existing Device, updating {device_class_name} is forbidden! ({', '.join(changed_ids)})"
                 # update, no matter what
                 complete_config["remote_devices"][device_class_name].update(devices[device_class_name])
 
             else:  # device class not known, just copy the dict
                 complete_config["remote_devices"][device_class_name] = devices[device_class_name]
 
-        with open(config_file, "w") as config_stream:
-            yaml.safe_dump(complete_config, config_stream)
+        if complete_config == loaded_config:
+            logger.debug("Config %s is up to date", config_file)
+            return
+
+        # replace the target of a symlinked config, not the link itself
+        target_file = config_file.resolve()
+        # write to a temporary file first, a crash while dumping must not truncate a valid config
+        with tempfile.NamedTemporaryFile("w", dir=target_file.parent, prefix=f".{target_file.name}.",
+                                         delete=False) as config_stream:
+            try:
+                yaml.dump(complete_config, config_stream, Dumper=YamlDumper)
+            except Exception:
+                config_stream.close()
+                os.unlink(config_stream.name)
+                raise
+        try:
+            cls._set_file_attributes(config_stream.name, target_file if config_exists else None)
+            os.replace(config_stream.name, target_file)
+        except Exception:
+            os.unlink(config_stream.name)
+            raise
+
+    @staticmethod
+    def _set_file_attributes(temp_file: str, replaced_file: Path = None) -> None:
+        """The temporary file is private (0600), give it the attributes of the replaced config,
+        or the default mode of new files (umask) if there is no config yet
+
+        :param temp_file: temporary file which will replace the config
+        :param replaced_file: existing config, None for new configs
+        :return: None
+        """
+        if replaced_file is None:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_file, 0o666 & ~umask)
+            return
+
+        shutil.copymode(replaced_file, temp_file)
+        if hasattr(os, "chown"):
+            file_stat = os.stat(replaced_file)
+            try:
+                os.chown(temp_file, file_stat.st_uid, file_stat.st_gid)
+            except PermissionError:
+                logger.warning("Could not keep owner and group of %s", replaced_file)
 
     def __init__(self, config_file: Path):
 
         super().__init__()
-        with Path(config_file).open("r") as file:
-            remote_description = yaml.load(file, yaml.FullLoader)
+        with open(config_file, "rb") as file:
+            remote_description = yaml.load(file, YamlLoader)
 
         mqtt_settings = remote_description["mqtt_settings"]
         remote_devices = remote_description["remote_devices"]
@@ -105,20 +172,22 @@ class DeviceBridge:
         self._mqtt_client = mqtt.Client()
         self._mqtt_client.on_connect = self._on_connect
         self._mqtt_client.on_message = self._on_message
+        self._mqtt_client.max_inflight_messages_set(self._MAX_INFLIGHT_MESSAGES)
 
         if mqtt_settings["user"] is not None and mqtt_settings["pw"] is not None:
             self._mqtt_client.username_pw_set(username=mqtt_settings["user"],
                                               password=mqtt_settings["pw"])
         else:
-            logging.debug("Connect without credentials")
+            logger.debug("Connect without credentials")
 
         self._mqtt_client.connect(host=mqtt_settings["ip"],
                                   port=mqtt_settings["port"],
                                   keepalive=60)
 
-        mqtt_settings["f_publish"] = self._mqtt_client.publish
+        self._publish = self._mqtt_client.publish
+        mqtt_settings["f_publish"] = self._publish
 
-        assert set(remote_devices.keys()).issubset(set(self._supported_device_classes.keys()))
+        assert remote_devices.keys() <= self._supported_device_classes.keys()
         for remote_device_class, devices in remote_devices.items():
             for object_id, device_settings in devices.items():
                 device_settings["object_id"] = object_id
@@ -126,9 +195,15 @@ class DeviceBridge:
                                                                                                mqtt_settings)
                 self._devices[new_device.get_id()] = new_device
 
-        self._subscribed_channels_dict = {}
-        for topic_function_dict in [device.get_device_topics() for device in self._devices.values()]:
-            self._subscribed_channels_dict.update(topic_function_dict)
+        self._subscribed_channels_dict = {topic: function
+                                          for device in self._devices.values()
+                                          for topic, function in device.get_device_topics().items()}
+
+        # the discovery config of a device is static after its construction, serialize it only once
+        self._discovery_messages = {}
+        for dev_id, device in self._devices.items():
+            discovery_topic, discovery_config = device.get_discovery()
+            self._discovery_messages[dev_id] = (discovery_topic, encode_json(discovery_config))
 
         self._bridge_name = mqtt_settings["bridge_name"]
         self._node_channel = f'{mqtt_settings["operating_prefix"]}/{self._bridge_name}/#'
@@ -140,53 +215,73 @@ class DeviceBridge:
         """Abort the MQTT Thread
         """
         self._mqtt_client.loop_stop()
-        logging.debug("MQTT Thread Stopped")
+        logger.debug("MQTT Thread Stopped")
 
     def start(self):
         """Thread to call the "loop forever" function
         """
         self._mqtt_client.loop_start()
-        logging.debug("MQTT Thread Started")
+        logger.debug("MQTT Thread Started")
 
     def _on_connect(self, client, userdata, flags, rc):
         client.subscribe(self._node_channel)
 
-        logging.debug(f"subscribe on {self._node_channel}")
+        logger.debug("subscribe on %s", self._node_channel)
 
     def _on_message(self, client, userdata, msg):
 
+        # paho decodes the topic on every attribute access
+        topic = msg.topic
+        function = self._subscribed_channels_dict.get(topic, _MISSING)
+        if function is _MISSING:
+            logger.warning("Detect unsubscribed channel for this node: %s", topic)
+            return
+
         try:
-            function = self._subscribed_channels_dict[msg.topic]
             if function is not None:
-                logging.debug(f"Actor Message: {msg.topic} : {msg.payload.decode()}")
-                function(msg.payload.decode())
-            else:
-                logging.debug(f"Sensor Message: {msg.topic} : {msg.payload.decode()}")
-        except KeyError:
-            logging.warning(f"Detect unsubscribed channel for this node: {msg.topic}")
+                payload = msg.payload.decode()
+                logger.debug("Actor Message: %s : %s", topic, payload)
+                function(payload)
+            elif logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Sensor Message: %s : %s", topic, msg.payload.decode())
         except Exception as error:
-            logging.error(f"Catching unhandled error inside of an device: {error}")
+            logger.error("Catching unhandled error inside of an device: %s", error)
 
-    def configure_devices(self):
+    def configure_devices(self) -> list:
         """Register Bridge Devices by write the config in HASSIO style to the discovery channel
+
+        The messages are published back to back without waiting for each acknowledgement,
+        with a running network loop the returned infos allow to wait for all of them at once.
+
+        :return: list with the paho MQTTMessageInfo of each discovery message
         """
-        for dev_id, device in self._devices.items():
-            logging.debug(f"Configure: {dev_id}")
-            discover_info = device.get_discovery()
-            self._mqtt_client.publish(topic=discover_info[0],
-                                      payload=json.dumps(discover_info[1]),
-                                      retain=True,
-                                      qos=1)
-            logging.debug(f'{discover_info[0]}: "{discover_info[1]}"')
-
-    def delete_devices(self):
+        batch = []
+        for dev_id, (discovery_topic, discovery_payload) in self._discovery_messages.items():
+            logger.debug("Configure: %s", dev_id)
+            logger.debug('%s: "%s"', discovery_topic, discovery_payload)
+            batch.append((discovery_topic, discovery_payload, 1, True))
+        return self._publish_batch(batch)
+
+    def delete_devices(self) -> list:
         """Unregister all devices by flushing the Discovery Channel
+
+        :return: list with the paho MQTTMessageInfo of each message
+        """
+        batch = []
+        for dev_id, (discovery_topic, _) in self._discovery_messages.items():
+            logger.debug("Unlink: %s", dev_id)
+            batch.append((discovery_topic, "", 0, False))
+        return self._publish_batch(batch)
+
+    def _publish_batch(self, messages: List[Tuple[str, Union[str, bytes], int, bool]]) -> list:
+        """Publish prepared messages back to back
+
+        :param messages: list of (topic, payload, qos, retain) tuples
+        :return: list with the paho MQTTMessageInfo of each message
         """
-        for dev_id, device in self._devices.items():  # type: RemoteDevice
-            logging.debug(f"Unlink: {dev_id}")
-            discover_info = device.get_discovery()
-            self._mqtt_client.publish(topic=discover_info[0],
-                                      payload="")
+        publish = self._publish
+        return [publish(topic=topic, payload=payload, qos=qos, retain=retain)
+                for topic, payload, qos, retain in messages]
 
     def get_devices(self) -> Dict[str, RemoteDevice]:
         """Return a dict with all registered devices
@@ -1,45 +1,124 @@
 import hashlib
+import importlib
 import json
 import logging
-import time
-from collections import namedtuple, defaultdict
+import subprocess
+import threading
+from functools import partial
+from types import MappingProxyType
 
 try:
-    import espeak
+    import orjson
 except ImportError:
-    espeak = None
+    orjson = None
 
-try:
-    import gpiozero
-except ImportError:
-    gpiozero = None
 
-MQTTChannel = namedtuple("MQTTChannel", ["topic", "on_message"])
+def _encode_json_std(data) -> bytes:
+    """Serialize data to compact json bytes with the standard library"""
+    return json.dumps(data, separators=(",", ":")).encode()
+
+
+if orjson is not None:
+    def encode_json(data) -> bytes:
+        """Serialize data to compact json bytes with orjson,
+        data orjson rejects (i.e. integers above 64 bit) falls back to the standard library
+
+        :param data: json dumpable data
+        :return: json bytes
+        """
+        try:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return _encode_json_std(data)
+
+    def decode_json(data):
+        """Parse json with orjson,
+        json orjson rejects (i.e. NaN or integers above 64 bit) falls back to the standard library
+
+        :param data: json str or bytes
+        :return: parsed data
+        """
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return json.loads(data)
+else:
+    encode_json = _encode_json_std
+    decode_json = json.loads
+
+# optional hardware modules, imported on first use by the devices which need them
+espeak = None
+gpiozero = None
+
+logger = logging.getLogger(__name__)
+
+
+class MQTTChannel:
+    """MQTT topic of a device channel with the callback for incoming messages (None if not subscribed)
+    """
+    __slots__ = ("topic", "on_message")
+
+    def __init__(self, topic: str, on_message=None):
+        self.topic = topic
+        self.on_message = on_message
+
+
+def _import_optional(module_name: str):
+    """Import an optional module on first use and store it as module global
+
+    :param module_name: name of the module global (espeak, gpiozero)
+    :return: the module, None if it is not installed
+    """
+    module = globals()[module_name]
+    if module is None:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            return None
+        globals()[module_name] = module
+    return module
+
+
+# all supported remote devices, every subclass of RemoteDevice registers itself ({<classname>:<classobj>})
+_DEVICE_REGISTRY = {}
 
 
 class RemoteDevice:
+    __slots__ = ("_uid", "_object_id", "_device_class", "_config", "_discovery_prefix",
+                 "_operation_topics", "_state_topic", "_operating_prefix", "_logging_channel", "_publish",
+                 "_last_payloads")
+
     _BASE_CONFIG_REQ = {
         "name": str,  # Display Name
     }
 
     _CONFIG_REQ = {}
 
-    def __init__(self, device_settings: dict, mqtt_settings: dict):
+    # merged requirements, constant per class (see __init_subclass__)
+    _CONFIG_REQ_FULL = MappingProxyType({**_CONFIG_REQ, **_BASE_CONFIG_REQ})
 
-        uid_string = f"{mqtt_settings['operating_prefix']}_" \
-                     f"{mqtt_settings['bridge_name']}_" \
-                     f"{self.__class__.__name__}_" \
-                     f"{device_settings['object_id']}"
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._CONFIG_REQ_FULL = MappingProxyType({**cls._CONFIG_REQ, **cls._BASE_CONFIG_REQ})
+        # only the devices of this module are supported, subclasses elsewhere must not shadow them
+        if cls.__module__ == __name__:
+            _DEVICE_REGISTRY[cls.__name__] = cls
 
-        uid_hash = hashlib.new("sha1", data=uid_string.encode(), usedforsecurity=False)
-        self._uid = uid_hash.hexdigest()[:16]
+    def __init__(self, device_settings: dict, mqtt_settings: dict):
+
+        operating_prefix = mqtt_settings['operating_prefix']
+        bridge_name = mqtt_settings['bridge_name']
         self._object_id = device_settings['object_id']
         self._device_class = device_settings['device_class']
+        device_id = self.get_id()
+
+        uid_string = f"{operating_prefix}_{bridge_name}_{self.__class__.__name__}_{self._object_id}"
+        uid_hash = hashlib.sha1(uid_string.encode(), usedforsecurity=False)
+        self._uid = uid_hash.hexdigest()[:16]
 
         # prepare auto config dict
-        self._config: dict = {"device": {"identifiers": [f"{mqtt_settings['operating_prefix']}_"
-                                                         f"{mqtt_settings['bridge_name']}"],
-                                         "name": mqtt_settings['bridge_name']}, "name": device_settings["name"],
+        self._config: dict = {"device": {"identifiers": [f"{operating_prefix}_{bridge_name}"],
+                                         "name": bridge_name}, "name": device_settings["name"],
                               "unique_id": self._uid}
 
         # some devices may need special attributes to appear in a special manner in hassio,
@@ -51,65 +130,79 @@ class RemoteDevice:
                     assert attribute not in self._config.keys()
                     self._config[attribute] = value
             except (TypeError, AttributeError, KeyError):
-                logging.warning("Could not apply optional attributes!")
+                logger.warning("Could not apply optional attributes!")
             except AssertionError:
-                logging.warning(f"Could not overwrite a required item with the optional dict ({attribute})")
+                logger.warning("Could not overwrite a required item with the optional dict (%s)", attribute)
 
-        self._discovery_prefix = f"{mqtt_settings['discovery_prefix']}/" \
-                                 f"{device_settings['device_class']}/" \
-                                 f"{mqtt_settings['bridge_name']}/" \
-                                 f"{self.get_id()}/"
+        self._discovery_prefix = f"{mqtt_settings['discovery_prefix']}/{self._device_class}/{bridge_name}/{device_id}/"
 
         # store the discovery topic
         self._config["discovery_topic"] = f"{self._discovery_prefix}config"
 
         # prepare mqtt channels
-        self._operation_topics = defaultdict(MQTTChannel)
-        self._operating_prefix = f"{mqtt_settings['operating_prefix']}/" \
-                                 f"{mqtt_settings['bridge_name']}/" \
-                                 f"{self.get_id()}/"
+        self._operation_topics = {}
+        self._operating_prefix = f"{operating_prefix}/{bridge_name}/{device_id}/"
 
         self._logging_channel = None
         if mqtt_settings["logging"]:
-            self._logging_channel = f"{mqtt_settings['operating_prefix']}/" \
-                                    f"{mqtt_settings['bridge_name']}/" \
-                                    f"{self.get_id()}/" \
-                                    f"log"
+            self._logging_channel = self._operating_prefix + "log"
 
         self._add_channel(channel_name="state_topic",
                           sub_topic="state",
                           on_message=None)
+        # every device publishes its state, keep the topic at hand for _update_state
+        self._state_topic = self._operation_topics["state_topic"].topic
 
         # connect self._publish to the function publish
         self._publish = mqtt_settings["f_publish"]
+        self._last_payloads = {}
 
     def _log_remote(self, *args, **kwargs):
 
-        level = getattr(kwargs, "Level", logging.DEBUG)
+        level = kwargs.get("Level", logging.DEBUG)
+        log_enabled = logger.isEnabledFor(level)
+        if not log_enabled and self._logging_channel is None:
+            return
+
         print_string = "".join(map(str, args))
-        logging.log(level=level, msg=print_string)
+        if log_enabled:
+            logger.log(level, print_string)
         if self._logging_channel is not None:
             self._publish(topic=self._logging_channel,
                           payload=print_string,
                           retain=False,
                           qos=0)
 
-    def _update(self, channel_name: str, message: any, retain: bool = False, qos: int = 0) -> None:
+    def _update(self, channel_name: str, message: any, retain: bool = False, qos: int = 0,
+                force_update: bool = True) -> None:
+        """Publish the message to the channel name (must be added by add_channel first), see _publish_message"""
+
+        self._publish_message(self._operation_topics[channel_name].topic, message, retain, qos, force_update)
+
+    def _update_state(self, message: any, retain: bool = False, qos: int = 0, force_update: bool = True) -> None:
+        """Publish the message to the state channel without the channel lookup, see _publish_message"""
+
+        self._publish_message(self._state_topic, message, retain, qos, force_update)
+
+    def _publish_message(self, topic: str, message: any, retain: bool, qos: int, force_update: bool) -> None:
         """
-        Publish the message in json format to the channel name
-        (must be added by add_channel first)
+        Publish the message in json format (str is sent as it is),
+        remember the payload per topic to detect unchanged messages
 
-        :param channel_name: name of the device channel
+        :param topic: full mqtt topic
         :param message: any type of json dumpable data to publish
         :param retain: Retain flag for this message
         :param qos: qos level for this message
+        :param force_update: if false, skip the message if it equals the last one on this topic
         :return: None
         """
 
-        topic = self._operation_topics[channel_name].topic
-
         if not isinstance(message, str):
-            message = json.dumps(message)
+            message = encode_json(message)
+
+        if not force_update and self._last_payloads.get(topic) == message:
+            return
+        self._last_payloads[topic] = message
 
         self._publish(topic=topic,
                       payload=message,
@@ -166,8 +259,10 @@ class RemoteDevice:
         :return: auto discover tuple with the discovery topic on index 0
         """
 
-        auto_config = {**self._config, **{name: channel.topic for (name, channel) in self._operation_topics.items()}}
+        auto_config = self._config.copy()
         topic = auto_config.pop("discovery_topic")
+        for name, channel in self._operation_topics.items():
+            auto_config[name] = channel.topic
 
         return topic, auto_config
 
@@ -178,16 +273,14 @@ class RemoteDevice:
 
         :return: dict in form of {topic:callback_function}
         """
-        return dict([channel for name, channel in self._operation_topics.items()])
+        return {channel.topic: channel.on_message for channel in self._operation_topics.values()}
 
     @classmethod
-    def get_config_req(cls) -> dict:
-        """Returns a dict with the required keys and the expected data types as values
-        :return: dict
+    def get_config_req(cls) -> MappingProxyType:
+        """Returns a read only mapping with the required keys and the expected data types as values
+        :return: mapping
         """
-        config_req = cls._CONFIG_REQ.copy()
-        config_req.update(cls._BASE_CONFIG_REQ)
-        return config_req
+        return cls._CONFIG_REQ_FULL
 
 
 def supported_device_classes() -> dict:
@@ -198,19 +291,7 @@ def supported_device_classes() -> dict:
     :return: dict with the supported devices
     """
 
-    import sys
-    import inspect
-
-    # all classes in this module
-    cls_members = inspect.getmembers(sys.modules[__name__], inspect.isclass)
-
-    # only classes with base class Remote Device
-    supported_devices = {}
-    for class_name, class_obj in cls_members:
-        if RemoteDevice in inspect.getmro(class_obj) and class_obj != RemoteDevice:
-            supported_devices[class_name] = class_obj
-
-    return supported_devices
+    return dict(_DEVICE_REGISTRY)
 
 
 class ArbitrarySensor(RemoteDevice):
@@ -218,6 +299,8 @@ class ArbitrarySensor(RemoteDevice):
     Arbitrary Sensor to publish any data to hassio
     """
 
+    __slots__ = ()
+
     _CONFIG_REQ = {
         "device_class": str,  # Sensor Type (https://www.home-assistant.io/integrations/sensor#device-class)
         "unit_of_measurement": str  # ,  # Unit of measurement (W,C,V,A...)
@@ -234,7 +317,6 @@ class ArbitrarySensor(RemoteDevice):
         self._config["device_class"] = device_settings.get("device_class", "None")
         self._config["unit_of_measurement"] = device_settings.get("unit_of_measurement", "")
         self._config["value_template"] = "{{ value_json.value}}"
-        self._last_value = None
 
     def set_value(self, value, force_update=True) -> None:
         """The set function for this sensor,
@@ -245,12 +327,7 @@ class ArbitrarySensor(RemoteDevice):
 
         :return:
         """
-        if self._last_value == value and not force_update:
-            return
-
-        self._update(channel_name="state_topic",
-                     message=json.dumps({"value": value}))
-        self._last_value = value
+        self._update_state(message={"value": value}, force_update=force_update)
 
 
 class Switch(RemoteDevice):
@@ -260,6 +337,8 @@ class Switch(RemoteDevice):
     but its written to use devices as boolean variables
     """
 
+    __slots__ = ("_state",)
+
     def __init__(self, device_settings, mqtt_settings):
         device_settings["device_class"] = "switch"
         super().__init__(device_settings, mqtt_settings)
@@ -275,8 +354,7 @@ class Switch(RemoteDevice):
             self._state = "ON"
         else:
             self._state = "OFF"
-        self._update(channel_name="state_topic",
-                     message=self._state)
+        self._update_state(message=self._state)
 
     def get_value(self):
         return self._state
@@ -289,6 +367,8 @@ class RpiGpio(RemoteDevice):
     especially in hassio via auto configuration, supporting switch and binary sensor format
     """
 
+    __slots__ = ("_gpiozero_device", "_inverted", "_state_map", "_command_map")
+
     _CONFIG_REQ = {
         "device_class": str,  # binary_sensor or switch
         "pin": int,  # Pin Nr according to gpiozero
@@ -298,48 +378,52 @@ class RpiGpio(RemoteDevice):
     def __init__(self, device_settings, mqtt_settings):
         super(RpiGpio, self).__init__(device_settings=device_settings, mqtt_settings=mqtt_settings)
 
-        if gpiozero is None:
+        if _import_optional("gpiozero") is None:
             err_msg = "Could not import gpiozero. Unable to create this remote device!"
             self._log_remote(err_msg)
             raise ImportError(err_msg)
 
         self._gpiozero_device = None
+        self._command_map = {}
         self._inverted = device_settings["inverted"]
+        # translation between the mqtt and the pin state, chosen once instead of branching per event
+        if self._inverted:
+            self._state_map = {"ON": "OFF", "OFF": "ON"}
+        else:
+            self._state_map = {"ON": "ON", "OFF": "OFF"}
+
         if device_settings["device_class"] == "binary_sensor":
             self._gpiozero_device = gpiozero.DigitalInputDevice(pin=device_settings["pin"])
 
-            self._gpiozero_device.when_activated = lambda msg="ON": self._handle_pinchange(msg)
-            self._gpiozero_device.when_deactivated = lambda msg="OFF": self._handle_pinchange(msg)
+            self._gpiozero_device.when_activated = partial(self._handle_pinchange, "ON")
+            self._gpiozero_device.when_deactivated = partial(self._handle_pinchange, "OFF")
 
         elif device_settings["device_class"] == "switch":
             self._add_channel(channel_name="command_topic",
                               sub_topic="set",
                               on_message=self._handle_command)
             self._gpiozero_device = gpiozero.DigitalOutputDevice(pin=device_settings["pin"])
+            # command -> (pin action, resulting state)
+            pin_actions = {"ON": self._gpiozero_device.on, "OFF": self._gpiozero_device.off}
+            self._command_map = {command: (pin_actions[state], state) for command, state in self._state_map.items()}
 
     def _handle_command(self, target_state):
 
-        if self._inverted:
-            target_state = "ON" if target_state == "OFF" else "OFF"
-
-        if target_state == "ON":
-            self._gpiozero_device.on()
-
-        elif target_state == "OFF":
-            self._gpiozero_device.off()
+        entry = self._command_map.get(target_state)
+        if entry is not None:
+            action, target_state = entry
+            action()
 
-        self._update(channel_name="state_topic",
-                     message=target_state)
+        self._update_state(message=target_state)
 
     def _handle_pinchange(self, target_state):
-        if self._inverted:
-            target_state = "ON" if target_state == "OFF" else "OFF"
-
-        self._update(channel_name="state_topic",
-                     message=target_state)
+        # gpiozero only reports real state changes
+        self._update_state(message=self._state_map[target_state])
 
 
 class RpiRgb(RemoteDevice):
+    __slots__ = ("_gpiozero_device",)
+
     _CONFIG_REQ = {
         "device_class": str,  # binary_sensor or switch
         "pin_r": int,  # Red Pin Nr according to gpiozero
@@ -353,7 +437,7 @@ class RpiRgb(RemoteDevice):
 
         super(RpiRgb, self).__init__(device_settings=device_settings, mqtt_settings=mqtt_settings)
 
-        if gpiozero is None:
+        if _import_optional("gpiozero") is None:
             err_msg = "Could not import gpiozero. Unable to create this remote device!"
             self._log_remote(err_msg)
             raise ImportError(err_msg)
@@ -377,42 +461,47 @@ class RpiRgb(RemoteDevice):
 
     def _on_set(self, message):
 
-        message = json.loads(message)
-        try:
-            if message["state"] == "OFF":
-                self._gpiozero_device.off()
-                return
+        message = decode_json(message)
+        state = message.get("state")
 
-            if message["state"] == "ON":
-                try:
-                    color = message["color"]
-                except KeyError:
-                    try:
-                        brightness = int(255 * message["brightness"])
-                    except:
-                        brightness = 255
-                    color = {"r": brightness, "g": brightness, "b": brightness}
+        if state == "OFF":
+            self._gpiozero_device.off()
 
+        elif state == "ON":
+            color = message.get("color")
+            if color is None:
                 # may brightness here?
-                color = dict((key, (1 if color[key] >= 1 else 0)) for key in color)
-
-                rgb_tuple = (color["r"], color["g"], color["b"])
-                self._gpiozero_device.value = rgb_tuple
+                brightness = message.get("brightness")
+                level = 0 if isinstance(brightness, (int, float)) and 255 * brightness < 1 else 1
+                rgb_tuple = (level, level, level)
+            else:
+                try:
+                    rgb_tuple = (1 if color["r"] >= 1 else 0,
+                                 1 if color["g"] >= 1 else 0,
+                                 1 if color["b"] >= 1 else 0)
+                except KeyError:
+                    self._log_remote(f"Unsupported command structure: {message}")
+                    return
+            self._gpiozero_device.value = rgb_tuple
 
-        except KeyError:
+        else:
             self._log_remote(f"Unsupported command structure: {message}")
 
     def _publish_state(self, rgb):
 
-        if isinstance(rgb[0], float):
-            rgb = [int(value * 255) for value in rgb]
+        red, green, blue = rgb
+        if isinstance(red, float):
+            red, green, blue = int(red * 255), int(green * 255), int(blue * 255)
 
-        message = f"{rgb[0]}, {rgb[1]}, {rgb[2]}"
+        message = f"{red}, {green}, {blue}"
         self._update(channel_name="rgb_state_topic",
-                     message=message)
+                     message=message,
+                     force_update=False)
 
 
 class ESpeakTTS(RemoteDevice):
+    __slots__ = ()
+
     _CONFIG_REQ = {
         "device_class": str,  # Should always be tts
         "voice": str,  # ESpeak voice set (like 'mb-de6')
@@ -423,7 +512,7 @@ class ESpeakTTS(RemoteDevice):
     def __init__(self, device_settings, mqtt_settings):
         super(ESpeakTTS, self).__init__(device_settings=device_settings, mqtt_settings=mqtt_settings)
 
-        if espeak is None:
+        if _import_optional("espeak") is None:
             err_msg = "Could not import espeak. Unable to create this remote device!"
             self._log_remote(err_msg)
             raise ImportError(err_msg)
@@ -463,60 +552,49 @@ class SubprocessCall(RemoteDevice):
     The state channel will publish "on" during active process
     """
 
+    __slots__ = ("_call", "_running_process", "_observation_thread")
+
     _CONFIG_REQ = {
         "device_class": str,  # should be 'switch'
         "exec_path": str,  # Path app or file to execute (i.E. python.exe)
-        "arguments": str,  # space separated list of arguments ("--version -E")
-        "looptime": int  # polling time in seconds to check if the call is done
+        "arguments": str  # space separated list of arguments ("--version -E")
     }
 
     def __init__(self, device_settings, mqtt_settings):
         super(SubprocessCall, self).__init__(device_settings=device_settings, mqtt_settings=mqtt_settings)
 
-        try:
-            self._threading_module = __import__("threading", fromlist=["threading"])
-            self._subprocess_module = __import__("subprocess", fromlist=["subprocess"])
-        except ImportError:
-            err_msg = "Could not import threading and/or subprocess. Unable to create this remote device!"
-            self._log_remote(err_msg)
-            raise ImportError(err_msg)
-
-        self._call = [device_settings["exec_path"]]
+        call = [device_settings["exec_path"]]
         try:
             args = device_settings["arguments"]
             if isinstance(args, dict):
-                self._call.extend([param + " " + args[param] for param in args])
-            if isinstance(args, list):
-                self._call.extend(args)
-            if isinstance(args, str):
-                self._call.extend(args.split(" "))
+                # every parameter and its value are separate argv entries
+                call.extend(entry for param, value in args.items() for entry in (param, str(value)))
+            elif isinstance(args, list):
+                call.extend(args)
+            elif isinstance(args, str):
+                # split on any whitespace, repeated spaces do not produce empty arguments
+                call.extend(args.split())
 
         except KeyError:
             pass
+        self._call = tuple(call)
 
         self._log_remote("Device created: SubprocessCall is: ", self._call)
 
-        try:
-            self._looptime = device_settings["looptime"]
-        except KeyError:
-            self._looptime = 1
-
         self._running_process = None
         self._observation_thread = None
         self._add_channel(channel_name="command_topic",
                           sub_topic="set",
                           on_message=self._handle_command)
 
-    def _observation_function(self, pOpen, looptime: int = 1):
+    def _observation_function(self, pOpen):
 
-        self._update(channel_name="state_topic",
-                     message="ON")
+        self._update_state(message="ON")
 
-        while pOpen.poll() is None:
-            time.sleep(looptime)
+        # block until the process terminates, no polling
+        pOpen.wait()
 
-        self._update(channel_name="state_topic",
-                     message="OFF")
+        self._update_state(message="OFF")
         self._running_process = None
 
     def _handle_command(self, target_state: str):
@@ -535,13 +613,13 @@ class SubprocessCall(RemoteDevice):
                 return
 
             try:
-                self._running_process = self._subprocess_module.Popen(self._call)
+                self._running_process = subprocess.Popen(self._call)
             except Exception as error:
                 self._log_remote("{}".format(error))
             else:
-                thread_args = {"pOpen": self._running_process, "looptime": self._looptime}
-                self._observation_thread = self._threading_module.Thread(target=self._observation_function,
-                                                                         kwargs=thread_args)
+                thread_args = {"pOpen": self._running_process}
+                self._observation_thread = threading.Thread(target=self._observation_function,
+                                                            kwargs=thread_args)
                 self._observation_thread.start()
             return
 
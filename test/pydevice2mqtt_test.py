@@ -2,10 +2,14 @@
 Test for pydevice2mqtt module
 """
 
+import json
+import os
 import pytest
+import yaml
 from unittest.mock import MagicMock
 import unittest.mock
 from pathlib import Path
+from typing import Tuple
 
 EXAMPLE_MQTT_SETTINGS = {
     "pw": "secret",
@@ -27,8 +31,6 @@ def create_config_file(path: Path, device_classes: dict = None) -> None:
     :param device_classes: dict of classes to create ({<classname>:<classobj>})
     """
     import pydevice2mqtt
-    if path.exists():
-        path.unlink()
     all_devices: dict = {}
     if device_classes is None:
         device_classes = pydevice2mqtt.supported_device_classes()
@@ -48,53 +50,98 @@ def create_config_file(path: Path, device_classes: dict = None) -> None:
                                              config_file=path, force_update=False)
 
 
-def create_device_bridge(mocked_module, device_classes: dict = None, new_config: bool = True):
+def create_device_bridge(mocked_module, config_file: Path, device_classes: dict = None, new_config: bool = True):
     """
     Create a mocked device bridge
     :param mocked_module: mocked pydevice2mqtt module
+    :param config_file: config file to create or to use
     :param device_classes: dict of classes to create ({<classname>:<classobj>})
-    :param new_config: create a new config file and delete existing
+    :param new_config: create a new config file (the file must not exist yet)
     :return: mocked DeviceBridge Instance
     """
-    test_config_file = Path("test.yaml")
     if new_config:
-        create_config_file(path=test_config_file, device_classes=device_classes)
-    return mocked_module.DeviceBridge(config_file=test_config_file)
+        create_config_file(path=config_file, device_classes=device_classes)
+    return mocked_module.DeviceBridge(config_file=config_file)
 
 
-def test_device_configuration():
-    test_config_file = Path("test.yaml")
-    create_config_file(test_config_file)
+@pytest.fixture
+def mqtt_client(mocker) -> MagicMock:
+    """
+    Mock the paho client and the optional hardware modules
+
+    :return: mocked paho Client class
+    """
+    mqtt_client = mocker.patch("pydevice2mqtt.pydevice2mqtt.mqtt.Client")
+    mocker.patch.multiple("pydevice2mqtt.remote_devices", espeak=mocker.DEFAULT, gpiozero=mocker.DEFAULT)
+    return mqtt_client
+
 
+@pytest.fixture
+def device_mqtt_settings() -> Tuple[dict, MagicMock]:
+    """
+    Mqtt settings to create single devices without a bridge
+
+    :return: settings with a mocked publish function, the publish mock
+    """
+    publish = MagicMock()
+    return {**EXAMPLE_MQTT_SETTINGS, "f_publish": publish}, publish
 
-def test_mqtt_channels(mocker):
+
+@pytest.fixture(scope="session")
+def config_file(tmp_path_factory) -> Path:
+    """
+    Config file with one device of every supported class, created once for all tests
+    """
+    path = tmp_path_factory.mktemp("config") / "test.yaml"
+    create_config_file(path)
+    return path
+
+
+def test_device_configuration(config_file):
     import pydevice2mqtt
+    with open(config_file) as config_stream:
+        remote_devices = yaml.safe_load(config_stream)["remote_devices"]
+    assert remote_devices.keys() == pydevice2mqtt.supported_device_classes().keys()
+
+    # subclasses outside of the package do not replace the supported devices
+    class Switch(pydevice2mqtt.RemoteDevice):
+        pass
 
-    mqtt_client: MagicMock = mocker.patch("pydevice2mqtt.pydevice2mqtt.mqtt.Client")
-    mocker.patch("pydevice2mqtt.remote_devices.espeak")
-    mocker.patch("pydevice2mqtt.remote_devices.gpiozero")
+    assert pydevice2mqtt.supported_device_classes()["Switch"] is pydevice2mqtt.remote_devices.Switch
 
-    my_bridge: pydevice2mqtt.DeviceBridge = create_device_bridge(pydevice2mqtt)
+    # the requirements are shared by all callers
+    with pytest.raises(TypeError):
+        pydevice2mqtt.remote_devices.Switch.get_config_req()["name"] = int
 
-    subscribed_channels = []
 
-    for uid, device in my_bridge.get_devices().items():
+def test_mqtt_channels(mqtt_client, config_file):
+    import pydevice2mqtt
+
+    my_bridge: pydevice2mqtt.DeviceBridge = create_device_bridge(pydevice2mqtt, config_file=config_file,
+                                                                 new_config=False)
+
+    subscribed_channels = set()
+    devices = my_bridge.get_devices()
+    assert devices
+
+    for device in devices.values():
 
         device: pydevice2mqtt.RemoteDevice
         assert device.get_name() == EXAMPLE_DATA[str]
         for topic, function in device.get_device_topics().items():
             assert topic not in subscribed_channels
-            if str(topic).endswith("state"):
+            if topic.endswith("state"):
                 assert function is None
-            elif str(topic).endswith("set") or str(topic).endswith("command"):
+            elif topic.endswith(("set", "command")):
                 assert function is not None
-            subscribed_channels.append(topic)
+            subscribed_channels.add(topic)
 
         discover_topic, discover_info = device.get_discovery()
-        assert str(discover_topic).startswith(EXAMPLE_MQTT_SETTINGS["discovery_prefix"])
-        assert str(discover_topic).endswith("config")
-        assert str(discover_info["state_topic"]).startswith(EXAMPLE_MQTT_SETTINGS["operating_prefix"])
-        assert str(discover_info["state_topic"]).endswith("state")
+        state_topic = discover_info["state_topic"]
+        assert discover_topic.startswith(EXAMPLE_MQTT_SETTINGS["discovery_prefix"])
+        assert discover_topic.endswith("config")
+        assert state_topic.startswith(EXAMPLE_MQTT_SETTINGS["operating_prefix"])
+        assert state_topic.endswith("state")
         assert discover_info["device"]["name"] == EXAMPLE_MQTT_SETTINGS["bridge_name"]
         assert discover_info["device"]["identifiers"][0] == f"{EXAMPLE_MQTT_SETTINGS['operating_prefix']}_" \
                                                             f"{EXAMPLE_MQTT_SETTINGS['bridge_name']}"
@@ -104,16 +151,13 @@ def test_mqtt_channels(mocker):
     assert mqtt_client.called
 
 
-def test_arbitrary_sensor(mocker):
+def test_arbitrary_sensor(mqtt_client, tmp_path):
     import pydevice2mqtt
 
-    mqtt_client: MagicMock = mocker.patch("pydevice2mqtt.pydevice2mqtt.mqtt.Client")
-    mocker.patch("pydevice2mqtt.remote_devices.espeak")
-    mocker.patch("pydevice2mqtt.remote_devices.gpiozero")
-
     device_class = {"ArbitrarySensor": pydevice2mqtt.remote_devices.ArbitrarySensor}
 
     my_bridge: pydevice2mqtt.DeviceBridge = create_device_bridge(mocked_module=pydevice2mqtt,
+                                                                 config_file=tmp_path / "test.yaml",
                                                                  device_classes=device_class)
 
     sensor_instance: pydevice2mqtt.remote_devices.ArbitrarySensor
@@ -123,23 +167,27 @@ def test_arbitrary_sensor(mocker):
     assert sensor_instance.get_id() == expected_dev_id
     assert sensor_instance.get_object_id() == EXAMPLE_DATA[str]
     assert sensor_instance.get_name() == EXAMPLE_DATA[str]
-    assert len(mqtt_client.mock_calls) == 3
+    publish: MagicMock = mqtt_client.return_value.publish
+    assert publish.call_count == 0
     sensor_instance.set_value(1)
-    assert len(mqtt_client.mock_calls) == 4
-    set_value_call_kwargs = mqtt_client.mock_calls[-1].kwargs
-    try:
-        assert set_value_call_kwargs["payload"] == '{"value": 1}'
-    except TypeError:
-        print(set_value_call_kwargs)
-
-def test_switch(mocker):
+    assert publish.call_count == 1
+    assert json.loads(publish.call_args.kwargs["payload"]) == {"value": 1}
+    sensor_instance.set_value(1, force_update=False)
+    assert publish.call_count == 1
+    sensor_instance.set_value(2, force_update=False)
+    assert publish.call_count == 2
+
+    # every payload the standard json module accepts is published, with or without orjson
+    sensor_instance.set_value({1: 2})
+    assert json.loads(publish.call_args.kwargs["payload"]) == {"value": {"1": 2}}
+    sensor_instance.set_value(2 ** 70)
+    assert json.loads(publish.call_args.kwargs["payload"]) == {"value": 2 ** 70}
+
+def test_switch(mqtt_client, tmp_path):
     import pydevice2mqtt
-    mqtt_client: MagicMock = mocker.patch("pydevice2mqtt.pydevice2mqtt.mqtt.Client")
-    mocker.patch("pydevice2mqtt.remote_devices.espeak")
-    mocker.patch("pydevice2mqtt.remote_devices.gpiozero")
-
     device_class = {"Switch": pydevice2mqtt.remote_devices.Switch}
     my_bridge: pydevice2mqtt.DeviceBridge = create_device_bridge(mocked_module=pydevice2mqtt,
+                                                                 config_file=tmp_path / "test.yaml",
                                                                  device_classes=device_class)
     switch_instance: pydevice2mqtt.remote_devices.Switch
     expected_dev_id = f"Switch_{EXAMPLE_DATA[str]}"
@@ -147,7 +195,7 @@ def test_switch(mocker):
     assert switch_instance.get_id() == expected_dev_id
     assert switch_instance.get_object_id() == EXAMPLE_DATA[str]
     assert switch_instance.get_name() == EXAMPLE_DATA[str]
-    assert len(mqtt_client.mock_calls) == 3
+    assert mqtt_client.return_value.publish.call_count == 0
     for set_value in ["ON", 1, True]:
         switch_instance.set_value(set_value)
         assert switch_instance.get_value() == "ON"
@@ -160,19 +208,162 @@ def test_switch(mocker):
         switch_instance.set_value("ON")
         assert switch_instance.get_value() == "ON"
 
-    print(switch_instance.get_discovery())
+    # the discovery config is a fresh copy, changes by the caller do not reach the device
+    discovery_topic, discovery_config = switch_instance.get_discovery()
+    discovery_config["payload_on"] = "changed"
+    assert switch_instance.get_discovery() == (discovery_topic, {**discovery_config, "payload_on": "ON"})
+
 
-def test_additional_config(mocker):
+def test_numeric_bridge_name(device_mqtt_settings):
     import pydevice2mqtt
 
-    mocker.patch("pydevice2mqtt.pydevice2mqtt.mqtt.Client")
-    mocker.patch("pydevice2mqtt.remote_devices.espeak")
-    mocker.patch("pydevice2mqtt.remote_devices.gpiozero")
+    # yaml loads bridge names like 1 as int
+    mqtt_settings, _ = device_mqtt_settings
+    mqtt_settings["bridge_name"] = 1
+    device_settings = {"name": "MySwitch", "object_id": "switch", "device_class": "switch"}
+    switch_instance = pydevice2mqtt.remote_devices.Switch(device_settings, mqtt_settings)
+    discovery_topic, discovery_config = switch_instance.get_discovery()
+    assert discovery_topic == "homeassistant/switch/1/Switch_switch/config"
+    assert discovery_config["state_topic"] == "pydevice2mqtt/1/Switch_switch/state"
+
 
-    test_config_file = Path("test.yaml")
+def test_rpi_gpio(mocker, device_mqtt_settings):
+    import pydevice2mqtt
+    gpiozero: MagicMock = mocker.patch("pydevice2mqtt.remote_devices.gpiozero")
+
+    mqtt_settings, publish = device_mqtt_settings
+    device_settings = {"name": "MyPin", "object_id": "GPIO_PIN4", "device_class": "switch",
+                       "pin": 4, "inverted": True}
+    switch_instance = pydevice2mqtt.remote_devices.RpiGpio(device_settings, mqtt_settings)
+
+    switch_instance._handle_command("ON")
+    assert gpiozero.DigitalOutputDevice.return_value.off.called
+    assert publish.call_args.kwargs["payload"] == "OFF"
+    switch_instance._handle_command("OFF")
+    assert gpiozero.DigitalOutputDevice.return_value.on.called
+    assert publish.call_args.kwargs["payload"] == "ON"
+
+    device_settings = {"name": "MyPin", "object_id": "GPIO_PIN5", "device_class": "binary_sensor",
+                       "pin": 5, "inverted": False}
+    sensor_instance = pydevice2mqtt.remote_devices.RpiGpio(device_settings, mqtt_settings)
+    gpiozero.DigitalInputDevice.return_value.when_activated()
+    assert publish.call_args.kwargs["payload"] == "ON"
+    assert publish.call_args.kwargs["topic"].endswith(f"{sensor_instance.get_id()}/state")
+    gpiozero.DigitalInputDevice.return_value.when_deactivated()
+    assert publish.call_args.kwargs["payload"] == "OFF"
+
+
+def test_rpi_rgb(mocker, device_mqtt_settings):
+    import pydevice2mqtt
+    gpiozero: MagicMock = mocker.patch("pydevice2mqtt.remote_devices.gpiozero")
+
+    mqtt_settings, _ = device_mqtt_settings
+    device_settings = {"name": "MyLed", "object_id": "LED", "device_class": "light",
+                       "pin_r": 1, "pin_g": 2, "pin_b": 3, "active_high": True, "pwm_led": False}
+    rgb_instance = pydevice2mqtt.remote_devices.RpiRgb(device_settings, mqtt_settings)
+    rgb_led: MagicMock = gpiozero.RGBLED.return_value
+
+    rgb_instance._on_set('{"state": "ON", "color": {"r": 255, "g": 0, "b": 12}}')
+    assert rgb_led.value == (1, 0, 1)
+    rgb_instance._on_set('{"state": "ON", "brightness": 0}')
+    assert rgb_led.value == (0, 0, 0)
+    rgb_instance._on_set('{"state": "ON"}')
+    assert rgb_led.value == (1, 1, 1)
+    # json the standard library accepts is handled with or without orjson
+    rgb_instance._on_set('{"state": "ON", "color": {"r": 0, "g": 1180591620717411303424, "b": 0}}')
+    assert rgb_led.value == (0, 1, 0)
+    rgb_instance._on_set('{"state": "ON", "brightness": NaN}')
+    assert rgb_led.value == (1, 1, 1)
+    rgb_instance._on_set('{"state": "OFF"}')
+    assert rgb_led.off.called
+
+
+def test_subprocess_call(device_mqtt_settings):
+    import sys
+    import pydevice2mqtt
+
+    mqtt_settings, publish = device_mqtt_settings
+    device_settings = {"name": "MyCall", "object_id": "python_version", "device_class": "switch",
+                       "exec_path": sys.executable, "arguments": "--version"}
+    call_instance = pydevice2mqtt.remote_devices.SubprocessCall(device_settings, mqtt_settings)
+
+    call_instance._handle_command("ON")
+    call_instance._observation_thread.join(timeout=10)
+    assert not call_instance._observation_thread.is_alive()
+    states = [publish_call.kwargs["payload"] for publish_call in publish.call_args_list
+              if publish_call.kwargs["topic"].endswith("state")]
+    assert states == ["ON", "OFF"]
+
+    device_settings = {"name": "MyCall", "object_id": "python_command", "device_class": "switch",
+                       "exec_path": sys.executable, "arguments": {"-c": "pass"}}
+    call_instance = pydevice2mqtt.remote_devices.SubprocessCall(device_settings, mqtt_settings)
+    assert call_instance._call == (sys.executable, "-c", "pass")
+
+    device_settings["arguments"] = "-c  pass"
+    call_instance = pydevice2mqtt.remote_devices.SubprocessCall(device_settings, mqtt_settings)
+    assert call_instance._call == (sys.executable, "-c", "pass")
+
+    # backslashes and quotes are passed unchanged
+    device_settings["arguments"] = r"C:\scripts\run.py say it's"
+    call_instance = pydevice2mqtt.remote_devices.SubprocessCall(device_settings, mqtt_settings)
+    assert call_instance._call == (sys.executable, r"C:\scripts\run.py", "say", "it's")
+
+
+def test_log_remote(caplog, device_mqtt_settings):
+    import logging
+    import pydevice2mqtt
+
+    mqtt_settings, publish = device_mqtt_settings
+    device_settings = {"name": "MySwitch", "object_id": "log_switch", "device_class": "switch"}
+    switch_instance = pydevice2mqtt.remote_devices.Switch(device_settings, mqtt_settings)
+
+    with caplog.at_level(logging.WARNING, logger="pydevice2mqtt.remote_devices"):
+        switch_instance._log_remote("suppressed")
+        switch_instance._log_remote("value: ", 1, Level=logging.WARNING)
+    assert [record.getMessage() for record in caplog.records] == ["value: 1"]
+    assert publish.call_args.kwargs["topic"].endswith("log")
+    assert publish.call_count == 2
+
+    mqtt_settings["logging"] = False
+    switch_instance = pydevice2mqtt.remote_devices.Switch(device_settings, mqtt_settings)
+    publish.reset_mock()
+    switch_instance._log_remote("not published")
+    assert not publish.called
+
+
+def test_on_message(mqtt_client, tmp_path):
+    import pydevice2mqtt
+    device_class = {"Switch": pydevice2mqtt.remote_devices.Switch}
+    my_bridge: pydevice2mqtt.DeviceBridge = create_device_bridge(mocked_module=pydevice2mqtt,
+                                                                 config_file=tmp_path / "test.yaml",
+                                                                 device_classes=device_class)
+    switch_instance = my_bridge.get_devices()[f"Switch_{EXAMPLE_DATA[str]}"]
+    topics = switch_instance.get_device_topics()
+    command_topic = [topic for topic, function in topics.items() if function is not None][0]
+    state_topic = [topic for topic, function in topics.items() if function is None][0]
+
+    my_bridge._on_message(None, None, MagicMock(topic=command_topic, payload=b"ON"))
+    assert switch_instance.get_value() == "ON"
+    my_bridge._on_message(None, None, MagicMock(topic=state_topic, payload=b"OFF"))
+    assert switch_instance.get_value() == "ON"
+    my_bridge._on_message(None, None, MagicMock(topic="unknown/topic", payload=b"OFF"))
+    assert switch_instance.get_value() == "ON"
+    my_bridge._on_message(None, None, MagicMock(topic=command_topic, payload=b"OFF"))
+    assert switch_instance.get_value() == "OFF"
+
+
+def test_additional_config(mqtt_client, tmp_path):
+    import pydevice2mqtt
+
+    test_config_file = tmp_path / "test.yaml"
     device_class = {"RpiGpio": pydevice2mqtt.remote_devices.RpiGpio}
     create_config_file(test_config_file, device_classes=device_class)
 
+    # a new config gets the default mode of new files
+    umask = os.umask(0)
+    os.umask(umask)
+    assert test_config_file.stat().st_mode & 0o777 == 0o666 & ~umask
+
     device_config: dict = {"RpiGpio": {
         "GPIO_PIN4":
             {
@@ -194,8 +385,26 @@ def test_additional_config(mocker):
             }}}
 
     pydevice2mqtt.DeviceBridge.update_config(devices=device_config, config_file=test_config_file)
+
+    # rewriting the config keeps its permissions
+    test_config_file.chmod(0o640)
+    pydevice2mqtt.DeviceBridge.update_config(devices=device_config2, config_file=test_config_file)
+    assert test_config_file.stat().st_mode & 0o777 == 0o640
+
+    # unchanged config (as on every start of the README example), the file must not be rewritten
+    config_mtime = test_config_file.stat().st_mtime_ns
     pydevice2mqtt.DeviceBridge.update_config(devices=device_config2, config_file=test_config_file)
+    pydevice2mqtt.DeviceBridge.update_config(devices=device_config2, config_file=test_config_file,
+                                             force_update=True)
+    assert test_config_file.stat().st_mtime_ns == config_mtime
+
+    # changing an existing device requires force_update
+    changed_config = {"RpiGpio": {"GPIO_PIN5": {**device_config2["RpiGpio"]["GPIO_PIN5"], "pin": 5}}}
+    with pytest.raises(AssertionError):
+        pydevice2mqtt.DeviceBridge.update_config(devices=changed_config, config_file=test_config_file)
+    assert test_config_file.stat().st_mtime_ns == config_mtime
     my_bridge: pydevice2mqtt.DeviceBridge = create_device_bridge(mocked_module=pydevice2mqtt,
+                                                                 config_file=test_config_file,
                                                                  new_config=False)
     devices = my_bridge.get_devices()
     assert len(devices) == 3
@@ -203,5 +412,15 @@ def test_additional_config(mocker):
     assert devices["RpiGpio_GPIO_PIN5"].get_discovery()[1]["gen_attr"] == "unrequired_info"
     print(devices["RpiGpio_GPIO_PIN5"].get_discovery())
 
+    # a symlinked config stays a symlink, its target is updated
+    linked_config_file = tmp_path / "linked.yaml"
+    linked_config_file.symlink_to(test_config_file)
+    pydevice2mqtt.DeviceBridge.update_config(devices=changed_config, config_file=linked_config_file,
+                                             force_update=True)
+    assert linked_config_file.is_symlink()
+    with open(test_config_file) as config_stream:
+        assert yaml.safe_load(config_stream)["remote_devices"]["RpiGpio"]["GPIO_PIN5"]["pin"] == 5
+
+
 if __name__ == "__main__":
     pytest.main(["-s", __file__])